@@ -1,72 +1,29 @@
 import os
+import re
 import json
 import asyncio
 from typing import List, Dict, Any, Optional
 import datetime
+import hashlib
+from collections import OrderedDict
+from itertools import islice
 
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
-from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, SystemMessage, ToolMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
 
-class FastnAgent:
-    def __init__(self, openai_api_key: str = None, mcp_servers: Dict[str, Dict[str, str]] = None):
-        """
-        Initialize the FastnAgent
-        
-        Args:
-            openai_api_key: OpenAI API key
-            mcp_servers: Dictionary of MCP servers, e.g. {'fastn': {'transport': 'sse', 'url': 'http://localhost:8000/sse/?api_key=xxx'}}
-        """
-        self.client = None
-        self.agent = None
-        self.tools = None
-        self.chat_history = []
-        self.tool_results = {}  # Store tool results by tool call ID
-        
-        # Set MCP servers
-        self.mcp_servers = mcp_servers
-        
-        # Set OpenAI API key if provided
-        if openai_api_key:
-            os.environ["OPENAI_API_KEY"] = openai_api_key
-    
-    async def initialize(self):
-        """Initialize the MCP client and create the agent"""
-        # Configure the MCP client with the provided servers
-        self.client = MultiServerMCPClient(self.mcp_servers)
-        
-        print("\n====== FETCHING TOOLS FROM MCP SERVERS ======")
-        # Load tools from all configured servers
-        all_tools = []
-        
-        for server_name, connection in self.mcp_servers.items():
-            print(f"\nConnecting to server: {server_name}")
-            print(f"Connection type: {connection.get('transport', 'unknown')}")
-            print(f"Connection URL: {connection.get('url', 'N/A')}")
-            
-            try:
-                server_tools = await load_mcp_tools(None, connection=connection)
-                print(f"✅ Successfully loaded {len(server_tools)} tools from {server_name}")
-                all_tools.extend(server_tools)
-                
-                # Log detailed info about each tool
-                for i, tool in enumerate(server_tools):
-                    print(f"\nTool #{i+1}: {tool.name}")
-                    print(f"  Description: {tool.description}")
-                    
-                    # Show args schema if available
-                    if hasattr(tool, 'args_schema'):
-                        print(f"  Args Schema: {tool.args_schema.__name__ if hasattr(tool.args_schema, '__name__') else type(tool.args_schema).__name__}")
-            except Exception as e:
-                print(f"❌ Error loading tools from {server_name}: {str(e)}")
-        
-        self.tools = all_tools
-        print(f"\n✅ Total tools loaded: {len(self.tools)}")
-        
-        # Define system prompt for JSON schema validation
-        system_prompt = """You are a helpful assistant that processes user requests through various tools.
+# System prompt for JSON schema validation.
+# Kept as a static module-level constant so it is byte-identical at the head of
+# every request and can be served from the provider's prompt cache. Do not
+# interpolate timestamps or session data into it; put dynamic context in later
+# messages instead. Any edit here invalidates every cached prefix.
+_SYSTEM_PROMPT = """You are a helpful assistant that processes user requests through various tools.
 
 CRITICAL INSTRUCTION FOR ALL TOOL CALLS:
 
@@ -162,49 +119,326 @@ IMPORTANT FOR SEQUENTIAL OPERATIONS:
 
 This is EXTREMELY important. If you send schemas instead of values, the tools will fail.
 """
+
+# Matches an escape-free documentId/docId string field in a raw createDoc result.
+# It is only trusted when the result holds a single documentId/docId key; anything
+# else (several keys, numeric IDs, escaped strings) falls back to a full JSON parse
+_DOC_ID_RE = re.compile(r'"(?:documentId|docId)"\s*:\s*"([^"\\]+)"')
+_DOC_ID_KEY_RE = re.compile(r'"(?:documentId|docId)"\s*:')
+
+def _canon(value) -> str:
+    """Serialize a tool input to canonical JSON (sorted keys, compact) for cache keys and logging"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+# Sentinel for attributes missing from agent actions
+_MISSING = object()
+
+def _handle_ai(state, msg):
+    """Track the latest assistant message and the latest tool calls it made"""
+    state["last_ai"] = msg
+    if msg.tool_calls:
+        state["tool_calls"] = msg.tool_calls
+
+def _handle_tool(state, msg):
+    """Collect a tool message as a chat history entry"""
+    if msg.tool_call_id:
+        state["tool_messages"].append({
+            "role": "tool",
+            "name": msg.name,
+            "content": msg.content,
+            "tool_call_id": msg.tool_call_id
+        })
+
+# Post-processing handlers for agent response messages, dispatched by exact type
+_HANDLERS = {
+    AIMessage: _handle_ai,
+    AIMessageChunk: _handle_ai,
+    ToolMessage: _handle_tool,
+}
+
+# Prompt template shared by every agent; built once at import time
+_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessage(content=_SYSTEM_PROMPT),
+    MessagesPlaceholder(variable_name="messages")
+])
+
+class _BoundedDict(OrderedDict):
+    """OrderedDict that evicts its oldest entries once it grows past maxsize, never evicting pinned keys"""
+    
+    def __init__(self, maxsize: int = 256, pinned=("last_document_id",)):
+        self.maxsize = maxsize
+        self.pinned = frozenset(pinned)
+        super().__init__()
+    
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        
+        while len(self) > self.maxsize:
+            oldest = next((k for k in self if k not in self.pinned), None)
+            if oldest is None:
+                break
+            del self[oldest]
+
+class _CachingTool(BaseTool):
+    """Tool wrapper that reuses the stored result when the same tool is re-issued with the same input within one turn"""
+    
+    tool: BaseTool
+    agent: Any
+    
+    def _run(self, *args: Any, config: RunnableConfig, run_manager=None, **kwargs: Any) -> Any:
+        return self.tool._run(*args, config=config, run_manager=run_manager, **kwargs)
+    
+    async def _arun(self, *args: Any, config: RunnableConfig, run_manager=None, **kwargs: Any) -> Any:
+        input_canon = _canon(kwargs)
+        key = f"{self.name}:{input_canon}"
+        cached = self.agent.tool_results.get(key)
+        if cached is not None:
+            return cached["output"]
+        
+        # Identical calls from the same batch run concurrently; let them share the first one
+        in_flight = self.agent._turn_tool_calls.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+        
+        future = asyncio.get_running_loop().create_future()
+        self.agent._turn_tool_calls[key] = future
+        try:
+            output = await self.tool._arun(*args, config=config, run_manager=run_manager, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when no other call is waiting on it
+            raise
+        else:
+            future.set_result(output)
+        finally:
+            # Failed calls may be retried; successful ones are served from tool_results
+            self.agent._turn_tool_calls.pop(key, None)
+        
+        self.agent._turn_tool_keys.add(key)
+        self.agent.tool_results[key] = {
+            "tool": self.name,
+            "input": kwargs,
+            "input_canon": input_canon,
+            "output": output,
+            "timestamp": datetime.datetime.now().isoformat()
+        }
+        return output
+
+class FastnAgent:
+    def __init__(self, openai_api_key: str = None, mcp_servers: Dict[str, Dict[str, str]] = None,
+                 max_history_messages: Optional[int] = 40, use_cache: bool = False,
+                 dedupe_tool_calls: bool = False):
+        """
+        Initialize the FastnAgent
+        
+        Args:
+            openai_api_key: OpenAI API key
+            mcp_servers: Dictionary of MCP servers, e.g. {'fastn': {'transport': 'sse', 'url': 'http://localhost:8000/sse/?api_key=xxx'}}
+            max_history_messages: Number of most recent messages sent to the model each turn, at least 1 (None sends the full history)
+            use_cache: Reply to repeated user messages from a cache instead of re-running the agent.
+                Leave disabled when tools have side effects or return changing data.
+            dedupe_tool_calls: Reuse the stored result when a tool is re-issued with identical input within one turn.
+                Leave disabled when a repeated call is meant to run again, e.g. sending the same email twice.
+        """
+        self.client = None
+        self.agent = None
+        self.tools = None
+        self.chat_history = []
+        self.tool_results = _BoundedDict()  # Store the most recent tool results by tool call ID
+        self._tool_result_seq = 0  # Monotonic counter for results stored without a tool call ID
+        self._session_tasks = {}  # Tasks holding open MCP sessions by server name: (task, close event)
+        
+        # LangChain messages converted from chat_history, extended incrementally per turn
+        self._lc_messages: List[BaseMessage] = []
+        self._lc_history_len = 0  # Number of chat_history entries already converted
+        self._tool_call_id_to_parent: Dict[str, int] = {}  # tool_call id -> chat_history index of the assistant that issued it
+        self._current_parent: Optional[int] = None  # chat_history index of the latest assistant message with tool_calls
+        self._tool_call_ids_seen = set()
+        
+        # Rolling window over the history sent to the model
+        if max_history_messages is not None and max_history_messages < 1:
+            raise ValueError("max_history_messages must be at least 1, or None to send the full history")
+        self.max_history_messages = max_history_messages
+        
+        # Exact-match cache of assistant replies, keyed by _response_cache_key
+        self.use_cache = use_cache
+        self.response_cache: Dict[str, str] = _BoundedDict(pinned=())
+        
+        self.dedupe_tool_calls = dedupe_tool_calls  # Wrap loaded tools in _CachingTool
+        self._turn_tool_keys = set()  # tool_results keys stored by _CachingTool during the current turn
+        self._turn_tool_calls: Dict[str, asyncio.Future] = {}  # In-flight _CachingTool calls by key
+        
+        # Set MCP servers
+        self.mcp_servers = mcp_servers
+        
+        # Set OpenAI API key if provided
+        if openai_api_key:
+            os.environ["OPENAI_API_KEY"] = openai_api_key
+    
+    async def initialize(self):
+        """Initialize the MCP client and create the agent"""
+        # Imported here to keep importing this module cheap; these pull in the
+        # MCP transports and the LangGraph runtime
+        from langchain_mcp_adapters.client import MultiServerMCPClient
+        from langchain_mcp_adapters.tools import load_mcp_tools
+        from langgraph.prebuilt import ToolNode, create_react_agent
+        
+        # Configure the MCP client with the provided servers
+        self.client = MultiServerMCPClient(self.mcp_servers)
+        
+        print("\n====== FETCHING TOOLS FROM MCP SERVERS ======")
+        
+        # Open one persistent session per server and keep it for the agent's lifetime.
+        # Each session is owned by its own task, which enters and later exits it,
+        # since the underlying transports use task-bound cancel scopes. Starting
+        # all tasks together lets the connection handshakes overlap.
+        loop = asyncio.get_running_loop()
+        ready = {}
+        for server_name in self.mcp_servers:
+            ready[server_name] = loop.create_future()
+            close = asyncio.Event()
+            task = asyncio.create_task(self._hold_session(server_name, ready[server_name], close))
+            self._session_tasks[server_name] = (task, close)
+        
+        opened = await asyncio.gather(*ready.values(), return_exceptions=True)
+        results = {}
+        sessions = {}
+        for server_name, session in zip(ready, opened):
+            if isinstance(session, BaseException):
+                results[server_name] = session
+                del self._session_tasks[server_name]
+            else:
+                sessions[server_name] = session
+        
+        # Load tools from all open sessions concurrently
+        loaded = await asyncio.gather(
+            *[load_mcp_tools(session, connection=None) for session in sessions.values()],
+            return_exceptions=True
+        )
+        results.update(zip(sessions, loaded))
+        
+        # Log results in server order once all handshakes have completed
+        all_tools = []
+        
+        for server_name, connection in self.mcp_servers.items():
+            server_tools = results[server_name]
+            print(f"\nConnecting to server: {server_name}")
+            print(f"Connection type: {connection.get('transport', 'unknown')}")
+            print(f"Connection URL: {connection.get('url', 'N/A')}")
+            
+            if isinstance(server_tools, BaseException):
+                print(f"❌ Error loading tools from {server_name}: {str(server_tools)}")
+                continue
+            
+            print(f"✅ Successfully loaded {len(server_tools)} tools from {server_name}")
+            all_tools.extend(server_tools)
+            
+            # Log detailed info about each tool
+            for i, tool in enumerate(server_tools):
+                print(f"\nTool #{i+1}: {tool.name}")
+                print(f"  Description: {tool.description}")
+                
+                # Show args schema if available
+                if hasattr(tool, 'args_schema'):
+                    print(f"  Args Schema: {tool.args_schema.__name__ if hasattr(tool.args_schema, '__name__') else type(tool.args_schema).__name__}")
+        
+        # Route tool calls through the results store so identical calls are not re-sent
+        if self.dedupe_tool_calls:
+            all_tools = [
+                _CachingTool(
+                    name=tool.name,
+                    description=tool.description,
+                    args_schema=tool.args_schema,
+                    response_format=tool.response_format,
+                    metadata=tool.metadata,
+                    tool=tool,
+                    agent=self
+                )
+                for tool in all_tools
+            ]
+        
+        self.tools = all_tools
+        print(f"\n✅ Total tools loaded: {len(self.tools)}")
         
-        # Create a proper ChatPromptTemplate with the system message
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content=system_prompt),
-            MessagesPlaceholder(variable_name="messages")
-        ])
+        # ToolNode's async path runs all tool_calls of one assistant message
+        # concurrently, so independent MCP calls cost max() rather than sum()
+        tool_node = ToolNode(self.tools, handle_tool_errors=True)
         
         # Create the agent with proper prompt template
         self.agent = create_react_agent(
             "openai:gpt-4.1-mini", 
-            self.tools,
-            prompt=prompt
+            tool_node,
+            prompt=_PROMPT
         )
         print("Agent initialized with GPT-4.1-mini and custom system prompt")
     
+    async def _hold_session(self, server_name: str, ready: asyncio.Future, close: asyncio.Event):
+        """Own one MCP session: enter it, hand it over through ready, and exit it once close is set"""
+        try:
+            async with self.client.session(server_name) as session:
+                ready.set_result(session)
+                await close.wait()
+        except asyncio.CancelledError:
+            if not ready.done():
+                ready.cancel()
+            raise
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"Error closing session for {server_name}: {e}")
+    
+    async def aclose(self):
+        """Close all persistent MCP sessions opened by initialize"""
+        tasks = []
+        for task, close in self._session_tasks.values():
+            close.set()
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._session_tasks = {}
+    
     def reset_conversation(self):
         """Reset the conversation history"""
         self.chat_history = []
-        self.tool_results = {}
+        self.tool_results = _BoundedDict()
+        self._turn_tool_keys.clear()
+        self.response_cache = _BoundedDict(pinned=())
+        self._rebuild_lc_messages()
         return {"status": "success", "message": "Conversation reset"}
     
     def _extract_tool_results(self, steps):
         """Extract and store tool results from agent's intermediate steps"""
         extracted_results = {}
+        timestamp = datetime.datetime.now().isoformat()  # Shared by every step of this batch
         
         for step in steps:
             if not isinstance(step, tuple) or len(step) != 2:
                 continue
                 
             action, result = step
-            if not hasattr(action, 'tool') or not hasattr(action, 'tool_input'):
+            tool_name = getattr(action, 'tool', _MISSING)
+            tool_input = getattr(action, 'tool_input', _MISSING)
+            if tool_name is _MISSING or tool_input is _MISSING:
                 continue
                 
-            tool_name = action.tool
-            tool_input = action.tool_input
-            tool_id = getattr(action, 'id', None) or f"{tool_name}_{len(self.tool_results)}"
+            tool_id = getattr(action, 'id', None)
+            if not tool_id:
+                tool_id = f"{tool_name}_{self._tool_result_seq}"
+                self._tool_result_seq += 1
             
             # Store the tool result with detailed information
             tool_result = {
                 "tool": tool_name,
                 "input": tool_input,
+                "input_canon": _canon(tool_input),
                 "output": result,
-                "timestamp": datetime.datetime.now().isoformat()
+                "timestamp": timestamp
             }
             
             self.tool_results[tool_id] = tool_result
@@ -212,163 +446,294 @@ This is EXTREMELY important. If you send schemas instead of values, the tools wi
             
             # For specific tools, extract and store important data for easy reference
             if tool_name == "createDoc" and isinstance(result, str):
-                try:
-                    # Try to extract document ID from the result
-                    if "documentId" in result or "docId" in result:
-                        # Parse the result if it's JSON
-                        try:
-                            parsed_result = json.loads(result)
-                            doc_id = parsed_result.get("documentId") or parsed_result.get("docId")
-                            if doc_id:
-                                self.tool_results["last_document_id"] = doc_id
-                                extracted_results["last_document_id"] = doc_id
-                        except json.JSONDecodeError:
-                            # If not JSON, try to extract using string operations
-                            pass
-                except Exception as e:
-                    print(f"Error extracting document ID: {e}")
+                # Pull the document ID straight from the raw result when it is unambiguous,
+                # otherwise parse it and prefer the top-level documentId over docId
+                key_count = len(_DOC_ID_KEY_RE.findall(result))
+                match = _DOC_ID_RE.search(result) if key_count == 1 else None
+                doc_id = match.group(1) if match else None
+                if doc_id is None and key_count:
+                    try:
+                        parsed_result = json.loads(result)
+                    except json.JSONDecodeError:
+                        parsed_result = None
+                    if isinstance(parsed_result, dict):
+                        doc_id = parsed_result.get("documentId") or parsed_result.get("docId")
+                if doc_id:
+                    self.tool_results["last_document_id"] = doc_id
+                    extracted_results["last_document_id"] = doc_id
         
         return extracted_results
     
-    async def process_message(self, message: str, previous_messages: List[Dict[str, Any]] = None):
-        """
-        Process a user message and get a response from the agent
-        
-        Args:
-            message: User message
-            previous_messages: List of previous messages in the conversation
-            
-        Returns:
-            Dict containing:
-            - assistant_message: The assistant's response
-            - tool_results: Results of any tool calls made
-            - chat_history: Updated chat history
-        """
-        if not self.agent:
-            return {"error": "Agent not initialized. Please initialize first."}
-        
-        # Use provided chat history or start fresh
-        if previous_messages is not None:
-            self.chat_history = previous_messages
-        
-        # Add user message to history
-        self.chat_history.append({"role": "user", "content": message})
-        
-        # Convert chat history to LangChain message format and validate message sequence
-        messages = []
-        assistant_with_tool_calls = None
-        
-        # First pass: scan for any tool messages without preceding tool_calls
-        for i, msg in enumerate(self.chat_history):
-            # Check if this is a tool message without a preceding assistant message with tool_calls
-            if msg["role"] == "tool":
-                if i == 0 or self.chat_history[i-1]["role"] != "assistant" or "tool_calls" not in self.chat_history[i-1]:
-                    # Skip invalid tool messages that don't have a preceding assistant with tool_calls
-                    print(f"WARNING: Skipping invalid tool message that has no preceding assistant with tool_calls")
-                    continue
+    def _rebuild_lc_messages(self):
+        """Convert the whole chat history to LangChain messages, discarding the cache"""
+        self._lc_messages = []
+        self._lc_history_len = 0
+        self._tool_call_id_to_parent = {}
+        self._current_parent = None
+        self._tool_call_ids_seen = set()
         
-        # Second pass: build valid message sequence
-        tool_call_ids_seen = set()
-        
-        for msg in self.chat_history:
+        self._convert_new_history()
+    
+    def _convert_new_history(self):
+        """Convert history entries not yet in the cache, validating the message sequence"""
+        for i, msg in enumerate(self.chat_history[self._lc_history_len:], self._lc_history_len):
             if msg["role"] == "user":
-                messages.append(HumanMessage(content=msg["content"]))
+                self._lc_messages.append(HumanMessage(content=msg["content"]))
             
             elif msg["role"] == "assistant":
                 # Capture tool_calls for validation
                 if "tool_calls" in msg:
-                    assistant_with_tool_calls = msg
-                    tool_call_ids = [tc.get("id") for tc in msg["tool_calls"]] if "tool_calls" in msg else []
-                    tool_call_ids_seen = set()  # Reset seen tool call IDs for this assistant message
+                    self._current_parent = i
+                    for tc in msg["tool_calls"]:
+                        self._tool_call_id_to_parent[tc.get("id")] = i
+                    self._tool_call_ids_seen = set()  # Reset seen tool call IDs for this assistant message
                     
                     # Add the assistant message with tool_calls
-                    messages.append(AIMessage(
+                    self._lc_messages.append(AIMessage(
                         content=msg["content"],
                         tool_calls=msg["tool_calls"]
                     ))
                 else:
                     # Regular assistant message without tool_calls
-                    messages.append(AIMessage(content=msg["content"]))
-                    assistant_with_tool_calls = None  # Reset
+                    self._lc_messages.append(AIMessage(content=msg["content"]))
+                    self._current_parent = None  # Reset
             
-            elif msg["role"] == "tool" and assistant_with_tool_calls is not None:
+            elif msg["role"] == "tool":
                 # Only include tool messages that respond to a preceding assistant's tool_call
+                if self._current_parent is None:
+                    print(f"WARNING: Skipping invalid tool message that has no preceding assistant with tool_calls")
+                    continue
+                
                 tool_call_id = msg.get("tool_call_id")
                 
                 # Validate this tool message corresponds to one of the assistant's tool_calls
-                valid_tool_call_ids = [tc.get("id") for tc in assistant_with_tool_calls.get("tool_calls", [])]
-                
-                if tool_call_id in valid_tool_call_ids and tool_call_id not in tool_call_ids_seen:
+                if self._tool_call_id_to_parent.get(tool_call_id) == self._current_parent and tool_call_id not in self._tool_call_ids_seen:
                     # Add a valid tool message
-                    tool_call_ids_seen.add(tool_call_id)
-                    messages.append(ToolMessage(
+                    self._tool_call_ids_seen.add(tool_call_id)
+                    self._lc_messages.append(ToolMessage(
                         content=msg["content"],
                         tool_call_id=tool_call_id,
                         name=msg.get("name")
                     ))
+                else:
+                    print(f"WARNING: Skipping invalid tool message with unmatched tool_call_id {tool_call_id}")
+        
+        self._lc_history_len = len(self.chat_history)
+    
+    def _response_cache_key(self, message: str) -> str:
+        """
+        Build a response cache key from the normalized message, the assistant reply
+        it follows and the latest stored tool result, so context-dependent replies
+        like "yes" or "continue" only hit in the same context
+        """
+        normalized = " ".join(message.lower().split())
+        # Skip the user message just appended for this turn
+        previous_reply = next(
+            (str(m["content"]) for m in islice(reversed(self.chat_history), 1, None) if m["role"] == "assistant"),
+            ""
+        )
+        # Fingerprint the newest stored tool result by content; its key alone is
+        # often just "last_document_id", which is re-set on every createDoc
+        last_key = next(reversed(self.tool_results), None)
+        fingerprint = _canon([last_key, self.tool_results[last_key]]) if last_key is not None else ""
+        return hashlib.blake2b(f"{normalized}\0{previous_reply}\0{fingerprint}".encode()).hexdigest()
+    
+    def _windowed_messages(self):
+        """Return the most recent cached messages that fit the history window"""
+        if self.max_history_messages is None or len(self._lc_messages) <= self.max_history_messages:
+            return list(self._lc_messages)
+        
+        # Never start the window on a tool message split from its assistant tool_calls
+        start = len(self._lc_messages) - self.max_history_messages
+        while start > 0 and isinstance(self._lc_messages[start], ToolMessage):
+            start -= 1
+        
+        return self._lc_messages[start:]
+    
+    def _start_turn(self, message: str, previous_messages: Optional[List[Dict[str, Any]]]):
+        """
+        Record the user message and look it up in the response cache
+        
+        Returns:
+            Tuple of (cache_key, cached_response); cached_response is None on a miss
+        """
+        # Use provided chat history or start fresh. The cached LangChain messages
+        # are only rebuilt when the caller hands us a different history.
+        if previous_messages is not None:
+            if previous_messages is not self.chat_history or len(previous_messages) != self._lc_history_len:
+                self.chat_history = previous_messages
+                self._rebuild_lc_messages()
+        
+        # Deduplicated tool results only apply within the turn that produced them
+        for key in self._turn_tool_keys:
+            self.tool_results.pop(key, None)
+        self._turn_tool_keys.clear()
+        
+        # Add user message to history
+        self.chat_history.append({"role": "user", "content": message})
+        self._convert_new_history()
+        
+        # Answer repeated messages from the cache
+        cache_key = self._response_cache_key(message) if self.use_cache else None
+        if cache_key is not None and cache_key in self.response_cache:
+            cached_message = self.response_cache[cache_key]
+            self.chat_history.append({"role": "assistant", "content": cached_message})
+            self._convert_new_history()
+            return cache_key, {
+                "status": "success",
+                "assistant_message": cached_message,
+                "tool_results": {},
+                "chat_history": self.chat_history
+            }
+        
+        return cache_key, None
+    
+    def _finish_turn(self, cache_key: Optional[str], response: Dict[str, Any], prev_len: int):
+        """Store the messages produced by one agent run and build the structured response"""
+        # Extract and store tool results if available
+        new_tool_results = {}
+        if "intermediate_steps" in response:
+            new_tool_results = self._extract_tool_results(response["intermediate_steps"])
+        
+        # Process only the messages produced by this invocation
+        state = {"last_ai": None, "tool_calls": [], "tool_messages": []}
+        for msg in response["messages"][prev_len:]:
+            handler = _HANDLERS.get(type(msg))
+            if handler is not None:
+                handler(state, msg)
+        
+        last_assistant_message = state["last_ai"].content if state["last_ai"] is not None else None
+        tool_calls_info = state["tool_calls"]
+        
+        # Store tool messages
+        self.chat_history.extend(state["tool_messages"])
+        
+        # Add assistant message to history
+        if last_assistant_message is not None:
+            if tool_calls_info:
+                # Store assistant message with tool calls
+                self.chat_history.append({
+                    "role": "assistant", 
+                    "content": last_assistant_message,
+                    "tool_calls": tool_calls_info
+                })
+            else:
+                # Store regular assistant message
+                self.chat_history.append({
+                    "role": "assistant", 
+                    "content": last_assistant_message
+                })
+        
+        # Keep the cached LangChain messages in step with the stored history
+        self._convert_new_history()
+        
+        if cache_key is not None and last_assistant_message is not None:
+            self.response_cache[cache_key] = last_assistant_message
+        
+        # Return structured response for API usage
+        return {
+            "status": "success",
+            "assistant_message": last_assistant_message or "No response from assistant",
+            "tool_results": new_tool_results,
+            "chat_history": self.chat_history
+        }
+    
+    def _error_response(self, e: Exception):
+        """Log an agent error and build the structured error response"""
+        error_message = f"Error: {str(e)}"
+        print(error_message)
+        return {
+            "status": "error",
+            "error": error_message,
+            "chat_history": self.chat_history
+        }
+    
+    async def process_message(self, message: str, previous_messages: List[Dict[str, Any]] = None):
+        """
+        Process a user message and get a response from the agent
+        
+        Args:
+            message: User message
+            previous_messages: List of previous messages in the conversation
+            
+        Returns:
+            Dict containing:
+            - assistant_message: The assistant's response
+            - tool_results: Results of any tool calls made
+            - chat_history: Updated chat history
+        """
+        if not self.agent:
+            return {"error": "Agent not initialized. Please initialize first."}
+        
+        cache_key, cached_response = self._start_turn(message, previous_messages)
+        if cached_response is not None:
+            return cached_response
         
         # Get response from agent
         try:
+            messages = self._windowed_messages()
             response = await self.agent.ainvoke({"messages": messages})
+            return self._finish_turn(cache_key, response, len(messages))
+        
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def process_message_stream(self, message: str, previous_messages: List[Dict[str, Any]] = None,
+                                     result: Optional[Dict[str, Any]] = None):
+        """
+        Process a user message and stream the assistant's reply as it is generated
+        
+        Args:
+            message: User message
+            previous_messages: List of previous messages in the conversation
+            result: Optional dict that is cleared on entry and, once the stream is
+                exhausted, filled with the same dict process_message would have
+                returned. It stays empty if the stream is abandoned early.
             
-            # Extract and store tool results if available
-            new_tool_results = {}
-            if "intermediate_steps" in response:
-                new_tool_results = self._extract_tool_results(response["intermediate_steps"])
-            
-            # Process the response
-            last_assistant_message = None
-            tool_calls_info = []
+        Yields:
+            Text chunks of the assistant's responses. Text from separate model
+            steps (e.g. a reply written alongside tool calls, then the final
+            answer) is separated by a blank line.
+        """
+        if result is None:
+            result = {}
+        result.clear()
+        
+        if not self.agent:
+            result.update({"error": "Agent not initialized. Please initialize first."})
+            return
+        
+        cache_key, cached_response = self._start_turn(message, previous_messages)
+        if cached_response is not None:
+            yield cached_response["assistant_message"]
+            result.update(cached_response)
+            return
+        
+        # Stream model tokens while tracking the latest graph state
+        try:
+            messages = self._windowed_messages()
+            final_state = None
+            last_step = None
             
-            for msg in response["messages"]:
-                if isinstance(msg, AIMessage):
-                    last_assistant_message = msg.content
-                    
-                    # Capture tool calls for storage
-                    if hasattr(msg, 'tool_calls') and msg.tool_calls:
-                        tool_calls_info = msg.tool_calls
+            async for mode, chunk in self.agent.astream({"messages": messages}, stream_mode=["messages", "values"]):
+                if mode == "values":
+                    final_state = chunk
+                    continue
                 
-                # Store tool messages
-                if isinstance(msg, ToolMessage) and msg.tool_call_id:
-                    self.chat_history.append({
-                        "role": "tool",
-                        "name": msg.name,
-                        "content": msg.content,
-                        "tool_call_id": msg.tool_call_id
-                    })
+                msg, metadata = chunk
+                if isinstance(msg, AIMessageChunk) and isinstance(msg.content, str) and msg.content:
+                    step = metadata.get("langgraph_step")
+                    if last_step is not None and step != last_step:
+                        yield "\n\n"
+                    last_step = step
+                    yield msg.content
             
-            # Add assistant message to history
-            if last_assistant_message is not None:
-                if tool_calls_info:
-                    # Store assistant message with tool calls
-                    self.chat_history.append({
-                        "role": "assistant", 
-                        "content": last_assistant_message,
-                        "tool_calls": tool_calls_info
-                    })
-                else:
-                    # Store regular assistant message
-                    self.chat_history.append({
-                        "role": "assistant", 
-                        "content": last_assistant_message
-                    })
-            
-            # Return structured response for API usage
-            return {
-                "status": "success",
-                "assistant_message": last_assistant_message or "No response from assistant",
-                "tool_results": new_tool_results,
-                "chat_history": self.chat_history
-            }
+            if final_state is None:
+                raise RuntimeError("Agent stream ended without a final state")
+            result.update(self._finish_turn(cache_key, final_state, len(messages)))
         
         except Exception as e:
-            error_message = f"Error: {str(e)}"
-            print(error_message)
-            return {
-                "status": "error",
-                "error": error_message,
-                "chat_history": self.chat_history
-            }
+            result.update(self._error_response(e))
     
     def get_tool_results(self):
         """Get all stored tool results"""
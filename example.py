@@ -4,39 +4,166 @@
 import asyncio
 import json
 import os
+import uuid
 import argparse
-from app import FastnAgent
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Directory for storing chat history
 CHAT_HISTORY_DIR = "chat_history"
 
-def save_chat_history(history, session_id="default"):
-    """Save chat history to a local file"""
+# Number of turns between full chat history snapshots
+SNAPSHOT_INTERVAL = 20
+
+def _dumps(obj, indent=False):
+    """Serialize to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+def _loads(data):
+    """Deserialize JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _history_paths(session_id):
+    """Return the snapshot and append-log paths for a session"""
+    snapshot_file = os.path.join(CHAT_HISTORY_DIR, f"{session_id}.json")
+    return snapshot_file, snapshot_file + "l"
+
+def _read_log_id(log_file):
+    """Return the id from the header line of a JSONL log, or None if it has none"""
+    if not os.path.exists(log_file):
+        return None
+    with open(log_file, "rb") as f:
+        first_line = f.readline()
+    try:
+        header = _loads(first_line)
+    except json.JSONDecodeError:
+        return None
+    return header.get("log_id") if isinstance(header, dict) and "role" not in header else None
+
+def _sync_save_chat_history(history, session_id="default", saved_len=0):
+    """Append messages added since the last save to the session's JSONL log"""
     # Create directory if it doesn't exist
     if not os.path.exists(CHAT_HISTORY_DIR):
         os.makedirs(CHAT_HISTORY_DIR)
     
-    # Save chat history to file
-    history_file = os.path.join(CHAT_HISTORY_DIR, f"{session_id}.json")
-    with open(history_file, "w") as f:
-        json.dump(history, f, indent=2)
+    # History was rewritten rather than extended; the log can't represent that
+    if len(history) < saved_len:
+        return _sync_save_full_snapshot(history, session_id)
+    
+    # Append only the new messages, starting a fresh log with an id header that
+    # the next snapshot records as absorbed
+    _, log_file = _history_paths(session_id)
+    lines = [_dumps(msg) + b"\n" for msg in history[saved_len:]]
+    if not os.path.exists(log_file):
+        lines.insert(0, _dumps({"log_id": uuid.uuid4().hex}) + b"\n")
+    with open(log_file, "ab") as f:
+        f.write(b"".join(lines))
+    
+    print(f"Chat history saved to {log_file}")
+    return len(history)
+
+def _sync_save_full_snapshot(history, session_id="default"):
+    """Atomically write the full chat history and clear the JSONL log"""
+    # Create directory if it doesn't exist
+    if not os.path.exists(CHAT_HISTORY_DIR):
+        os.makedirs(CHAT_HISTORY_DIR)
+    
+    # Write to a temporary file and swap it in so a crash never leaves a partial snapshot.
+    # The snapshot records which log it absorbed, so a crash before the log is
+    # removed doesn't replay those messages a second time on load.
+    history_file, log_file = _history_paths(session_id)
+    tmp_file = history_file + ".tmp"
+    snapshot = {"absorbed_log_id": _read_log_id(log_file), "messages": history}
+    with open(tmp_file, "wb") as f:
+        f.write(_dumps(snapshot, indent=True))
+    os.replace(tmp_file, history_file)
+    
+    # Everything in the log is now part of the snapshot
+    if os.path.exists(log_file):
+        os.remove(log_file)
     
     print(f"Chat history saved to {history_file}")
+    return len(history)
 
-def load_chat_history(session_id="default"):
-    """Load chat history from a local file"""
-    history_file = os.path.join(CHAT_HISTORY_DIR, f"{session_id}.json")
+def _sync_load_chat_history(session_id="default"):
+    """Load chat history from the session's snapshot and replay its JSONL log"""
+    history_file, log_file = _history_paths(session_id)
     
+    if not os.path.exists(history_file) and not os.path.exists(log_file):
+        print(f"No chat history found for session {session_id}")
+        return []
+    
+    history = []
+    absorbed_log_id = None
     if os.path.exists(history_file):
         try:
-            with open(history_file, "r") as f:
-                return json.load(f)
+            with open(history_file, "rb") as f:
+                snapshot = _loads(f.read())
         except json.JSONDecodeError:
             print(f"Error reading chat history from {history_file}")
             return []
-    else:
-        print(f"No chat history found for session {session_id}")
-        return []
+        
+        # Snapshots written before logs were tracked are a bare message list
+        if isinstance(snapshot, dict):
+            history = snapshot.get("messages", [])
+            absorbed_log_id = snapshot.get("absorbed_log_id")
+        else:
+            history = snapshot
+    
+    # A log the snapshot already contains was left behind by a crash mid-snapshot;
+    # drop it rather than replaying it or appending new messages to it
+    log_id = _read_log_id(log_file)
+    if log_id is not None and log_id == absorbed_log_id:
+        os.remove(log_file)
+    elif os.path.exists(log_file):
+        torn_at = None
+        with open(log_file, "rb") as f:
+            if log_id is not None:
+                f.readline()
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    history.append(_loads(line))
+                except json.JSONDecodeError:
+                    # A torn final line from an interrupted write
+                    print(f"Error reading chat history from {log_file}")
+                    torn_at = offset
+                    break
+        
+        # Cut the log back to its last good line so later appends stay readable
+        if torn_at is not None:
+            if torn_at == 0:
+                os.remove(log_file)
+            else:
+                with open(log_file, "r+b") as f:
+                    f.truncate(torn_at)
+    
+    return history
+
+async def save_chat_history_async(history, session_id="default", saved_len=0):
+    """Append new chat history without blocking the event loop"""
+    return await asyncio.to_thread(_sync_save_chat_history, history, session_id, saved_len)
+
+async def save_full_snapshot_async(history, session_id="default"):
+    """Write a full chat history snapshot without blocking the event loop"""
+    return await asyncio.to_thread(_sync_save_full_snapshot, history, session_id)
+
+async def load_chat_history_async(session_id="default"):
+    """Load chat history without blocking the event loop"""
+    return await asyncio.to_thread(_sync_load_chat_history, session_id)
 
 async def run_interactive():
     """Run an interactive chat session with command-line input"""
@@ -76,57 +203,80 @@ async def run_interactive():
         }
     }
     
+    # Import the agent only once the prompts are done, so LangChain's import
+    # cost isn't paid before the user has typed anything
+    from app import FastnAgent
+    
     # Create and initialize the agent
     print(f"\nInitializing agent with {server_name} server...")
     agent = FastnAgent(openai_api_key, mcp_servers)
-    await agent.initialize()
-    
-    # Load previous chat history if available
-    session_id = args.session
-    chat_history = load_chat_history(session_id)
-    
-    print(f"\nWelcome to the FastnAgent Chat!")
-    print(f"Session: {session_id}")
-    print(f"Loaded {len(chat_history)} previous messages")
-    print("Type 'exit' to quit, 'reset' to clear history")
-    print("Your messages will be saved automatically")
-    
-    while True:
-        user_input = input("\n> ")
-        
-        if user_input.lower() == "exit":
-            print("Saving chat history and exiting...")
-            save_chat_history(chat_history, session_id)
-            break
+    try:
+        await agent.initialize()
         
-        elif user_input.lower() == "reset":
-            print("Resetting conversation history...")
-            chat_history = []
-            save_chat_history(chat_history, session_id)
-            agent.reset_conversation()
-            continue
+        # Load previous chat history if available
+        session_id = args.session
+        chat_history = await load_chat_history_async(session_id)
+        saved_len = len(chat_history)
+        turns = 0
         
-        print("Processing your message...")
-        response = await agent.process_message(user_input, chat_history)
+        print(f"\nWelcome to the FastnAgent Chat!")
+        print(f"Session: {session_id}")
+        print(f"Loaded {len(chat_history)} previous messages")
+        print("Type 'exit' to quit, 'reset' to clear history")
+        print("Your messages will be saved automatically")
         
-        # Update and save chat history
-        chat_history = response.get("chat_history", chat_history)
-        save_chat_history(chat_history, session_id)
-        
-        if response.get("status") == "success":
-            print(f"\nAgent: {response['assistant_message']}")
+        while True:
+            # Read input off the event loop so the MCP transports keep running
+            user_input = await asyncio.to_thread(input, "\n> ")
             
-            # Display tool results if any
-            if response.get("tool_results"):
-                print("\nTool Results:")
-                for tool_id, result in response["tool_results"].items():
-                    tool_name = result.get("tool", "unknown")
-                    output = result.get("output", "")
-                    print(f"  {tool_id}: {tool_name} - {str(output)[:50]}..." 
-                          if isinstance(output, str) and len(str(output)) > 50 
-                          else f"  {tool_id}: {tool_name} - {output}")
-        else:
-            print(f"\nError: {response.get('error', 'Unknown error')}")
+            if user_input.lower() == "exit":
+                print("Saving chat history and exiting...")
+                await save_full_snapshot_async(chat_history, session_id)
+                break
+            
+            elif user_input.lower() == "reset":
+                print("Resetting conversation history...")
+                chat_history = []
+                saved_len = await save_full_snapshot_async(chat_history, session_id)
+                agent.reset_conversation()
+                continue
+            
+            print("Processing your message...")
+            streamed = False
+            response = {}
+            async for chunk in agent.process_message_stream(user_input, chat_history, result=response):
+                if not streamed:
+                    print("\nAgent: ", end="", flush=True)
+                    streamed = True
+                print(chunk, end="", flush=True)
+            if streamed:
+                print()
+            
+            # Update and save chat history, taking a full snapshot every few turns
+            chat_history = response.get("chat_history", chat_history)
+            turns += 1
+            if turns % SNAPSHOT_INTERVAL == 0:
+                saved_len = await save_full_snapshot_async(chat_history, session_id)
+            else:
+                saved_len = await save_chat_history_async(chat_history, session_id, saved_len)
+            
+            if response.get("status") == "success":
+                if not streamed:
+                    print(f"\nAgent: {response['assistant_message']}")
+                
+                # Display tool results if any
+                if response.get("tool_results"):
+                    print("\nTool Results:")
+                    for tool_id, result in response["tool_results"].items():
+                        tool_name = result.get("tool", "unknown")
+                        output = result.get("output", "")
+                        text = output if isinstance(output, str) else str(output)
+                        print(f"  {tool_id}: {tool_name} - {text[:50]}{'...' if len(text) > 50 else ''}")
+            else:
+                print(f"\nError: {response.get('error', 'Unknown error')}")
+    finally:
+        # Close persistent MCP sessions on exit, EOF, Ctrl-C or errors
+        await agent.aclose()
 
 if __name__ == "__main__":
     # Run interactive chat